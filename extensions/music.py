@@ -1,36 +1,114 @@
 import asyncio
+import collections
+import logging
+import threading
 import discord
 from configs import lang
 from discord.ext import commands
 
-if not discord.opus.is_loaded():
-    discord.opus.load_opus('opus')
+log = logging.getLogger(__name__)
+
+YTDL_OPTIONS = {
+    'default_search': 'auto',
+    'quiet': True,
+}
+YTDL_MAX_CONCURRENT = 3  # global cap on simultaneous youtube-dl resolutions
+PREFETCH_COUNT = 2  # how many upcoming songs are resolved ahead of playback
+MAX_QUEUED_SONGS = 100  # per server, counting songs that are not resolved yet
+SKIP_VOTES_NEEDED = 3
+VOTE_FLUSH_DELAY = 0.25  # seconds to collect near-simultaneous skip votes into one reply
+
+# Message templates, resolved once at import instead of on every command.
+_M = lang['MUSIC']
+_NOW_PLAYING = str(_M['NOW_PLAYING'])
+_NOT_PLAYING = str(_M['NOT_PLAYING'])
+_ENQUEUE_PENDING = str(_M['ENQUEUE_PENDING'])
+_ENQUEUE_SUCCESS = str(_M['ENQUEUE_SUCCESS'])
+_VOLUME_CHANGE = str(_M['VOLUME_CHANGE'])
+_SKIP_REQUESTER = str(_M['SKIP_REQUESTER'])
+_SKIP_VOTE_PASSED = str(_M['SKIP_VOTE_PASSED'])
+_SKIP_VOTE_ADDED = str(_M['SKIP_VOTE_ADDED'])
+_SKIP_ALREADY_VOTED = str(_M['SKIP_ALREADY_VOTED'])
+_QUEUE_FULL = str(_M['QUEUE_FULL'])
+_READY_TO_PLAY = str(_M['READY_TO_PLAY'])
+_IN_ANOTHER_VOICE_CHANNEL = str(_M['IN_ANOTHER_VOICE_CHANNEL'])
+_NOT_A_VOICE_CHANNEL = str(_M['NOT_A_VOICE_CHANNEL'])
+_USER_NOT_IN_VOICE_CHANNEL = str(_M['USER_NOT_IN_VOICE_CHANNEL'])
+_VOICE_ENTRY = str(_M['VOICE_ENTRY'])
+_VOICE_ENTRY_LENGTH = ' [length: {}m {}s]'
+
+_YTDL_SEM = asyncio.Semaphore(YTDL_MAX_CONCURRENT)
+_opus_loaded = False
+
+
+def _ensure_opus():
+    """Loads libopus the first time the bot joins a voice channel."""
+    global _opus_loaded
+    if not _opus_loaded:
+        if not discord.opus.is_loaded():
+            discord.opus.load_opus('opus')
+        _opus_loaded = True
+
+
+async def _throttled_create(voice, song, opts, after):
+    """Creates a ytdl player, waiting for a free slot when too many are being resolved.
+
+    create_ytdl_player already runs youtube-dl's extract_info in the loop's executor,
+    so the semaphore is also what keeps that thread pool from being flooded.
+    """
+    async with _YTDL_SEM:
+        return await voice.create_ytdl_player(song, ytdl_options=opts, after=after)
+
+
+def _discard_player(player):
+    """Kills the ffmpeg process of a player that will never be started.
+
+    ProcessPlayer only reaps its process at the end of run(), so an unstarted
+    player would otherwise leave ffmpeg running.
+    """
+    process = getattr(player, 'process', None)
+    if process is not None and process.poll() is None:
+        process.kill()
+        process.communicate()
 
 
 class VoiceEntry:
-    def __init__(self, message, player):
+    __slots__ = ('requester', 'channel', 'player', 'done', '_cached')
+
+    def __init__(self, message, player, done):
         self.requester = message.author
         self.channel = message.channel
         self.player = player
+        self.done = done  # resolved by this player's after-callback
+        self._cached = None  # formatted description, built on first use
 
     def __str__(self):
-        fmt = lang['MUSIC']['VOICE_ENTRY']
-        duration = self.player.duration
-        if duration:
-            fmt = fmt + ' [length: {0[0]}m {0[1]}s]'.format(divmod(duration, 60))
+        s = self._cached
+        if s is None:
+            fmt = _VOICE_ENTRY
+            duration = self.player.duration
+            if duration:
+                minutes = duration // 60
+                fmt = fmt + _VOICE_ENTRY_LENGTH.format(minutes, duration - minutes * 60)
 
-        return fmt.format(player=self.player, requester=self.requester)
+            s = self._cached = fmt.format(player=self.player, requester=self.requester)
+        return s
 
 
 class VoiceState:
+    __slots__ = ('current', 'voice', 'bot', 'songs', '_songs_ready', 'ready', 'skip_votes',
+                 '_vote_flush_handle', 'prefetcher')
+
     def __init__(self, bot):
         self.current = None
         self.voice = None
         self.bot = bot
-        self.play_next_song = asyncio.Event()
-        self.songs = asyncio.Queue()
-        self.skip_votes = set()  # a set of user_ids that voted
-        self.audio_player = self.bot.loop.create_task(self.audio_player_task())
+        self.songs = collections.deque()  # pending (message, song) requests
+        self._songs_ready = asyncio.Event()  # set while songs is non-empty
+        self.ready = asyncio.Queue(maxsize=PREFETCH_COUNT)  # resolved VoiceEntry objects
+        self.skip_votes = []  # user_ids that voted; never more than SKIP_VOTES_NEEDED
+        self._vote_flush_handle = None
+        self.prefetcher = self.bot.loop.create_task(self._prefetch_task())
 
     def is_playing(self):
         if self.voice is None or self.current is None:
@@ -45,20 +123,119 @@ class VoiceState:
 
     def skip(self):
         self.skip_votes.clear()
+        if self._vote_flush_handle is not None:
+            self._vote_flush_handle.cancel()
+            self._vote_flush_handle = None
         if self.is_playing():
             self.player.stop()
 
-    def toggle_next(self):
-        self.bot.loop.call_soon_threadsafe(self.play_next_song.set)
+    def enqueue(self, message, song):
+        """Adds a song request for the prefetch task to resolve."""
+        self.songs.append((message, song))
+        self._songs_ready.set()
+
+    def clear_queue(self):
+        """Drops pending requests and prefetched songs so nothing starts after the current one."""
+        self.songs.clear()
+        self._songs_ready.clear()
+        while not self.ready.empty():
+            _discard_player(self.ready.get_nowait().player)
+
+    def add_skip_vote(self, voter_id, channel):
+        """Registers a vote and schedules a single tally message for the current burst of votes."""
+        self.skip_votes.append(voter_id)
+        if self._vote_flush_handle is None:
+            self._vote_flush_handle = self.bot.loop.call_later(VOTE_FLUSH_DELAY, self._flush_votes_cb, channel)
+        return len(self.skip_votes)
+
+    def _flush_votes_cb(self, channel):
+        self._vote_flush_handle = None
+        if self.skip_votes:
+            message = _SKIP_VOTE_ADDED.format(current_votes=len(self.skip_votes))
+            self.bot.loop.create_task(self._send(channel, message))
+
+    def toggle_next(self, done):
+        # Players usually call this from their own thread, but when it already runs on the
+        # loop thread we can skip the thread-safe hand-off (and its self-pipe wakeup).
+        if getattr(self.bot.loop, '_thread_id', None) == threading.get_ident():
+            self._finish_track(done)
+        else:
+            self.bot.loop.call_soon_threadsafe(self._finish_track, done)
+
+    @staticmethod
+    def _finish_track(done):
+        if not done.done():
+            done.set_result(None)
+
+    def advance(self):
+        """Starts the next ready song, unless one is still playing.
+
+        Called when a song finishes and whenever a new song becomes ready, so
+        playback no longer needs a task of its own.
+        """
+        if self.is_playing():
+            return
+
+        try:
+            self.current = self.ready.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+
+        self.current.done.add_done_callback(lambda _: self.advance())
+        self.current.player.start()
+        message = _NOW_PLAYING.format(current_song=self.current)
+        self.bot.loop.create_task(self._send(self.current.channel, message))
 
-    async def audio_player_task(self):
+    async def _send(self, channel, content):
+        """Sends a message, logging failures instead of raising them into playback code."""
+        try:
+            await self.bot.send_message(channel, content)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception('Could not send a music message to %s', channel)
+
+    async def _prefetch_task(self):
+        """Resolves queued requests into players while the current song plays."""
         while True:
-            self.play_next_song.clear()
-            self.current = await self.songs.get()
-            await self.bot.send_message(self.current.channel,
-                                        str(lang['MUSIC']['NOW_PLAYING']).format(current_song=self.current))
-            self.current.player.start()
-            await self.play_next_song.wait()
+            try:
+                await self._prefetch_next()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # One bad request must not stop the server's queue for good.
+                log.exception('Failed to prefetch a song')
+
+    async def _prefetch_next(self):
+        while not self.songs:
+            await self._songs_ready.wait()
+            self._songs_ready.clear()
+        message, song = self.songs.popleft()
+        if not self.songs:
+            self._songs_ready.clear()
+        # Each player resolves its own future, so a late callback from a skipped
+        # player cannot be mistaken for the end of the song that replaced it.
+        done = self.bot.loop.create_future()
+        try:
+            player = await _throttled_create(self.voice, song, YTDL_OPTIONS, lambda: self.toggle_next(done))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            fmt = 'An error occurred while processing this request: ```py\n{}: {}\n```'
+            await self._send(message.channel, fmt.format(type(e).__name__, e))
+            return
+
+        player.volume = 0.6
+        entry = VoiceEntry(message, player, done)
+        # Confirm in the background so an idle server starts playing without
+        # waiting for the message round-trip.
+        self.bot.loop.create_task(self._send(message.channel, _ENQUEUE_SUCCESS.format(entry=entry)))
+        try:
+            await self.ready.put(entry)  # blocks once PREFETCH_COUNT songs are waiting
+        except asyncio.CancelledError:
+            _discard_player(player)
+            raise
+        self.advance()
 
 
 class Music:
@@ -68,27 +245,37 @@ class Music:
         self.voice_states = {}
 
     def get_voice_state(self, server):
-        state = self.voice_states.get(server.id)
+        states = self.voice_states
+        sid = server.id
+        state = states.get(sid)
         if state is None:
-            state = VoiceState(self.bot)
-            self.voice_states[server.id] = state
+            state = states[sid] = VoiceState(self.bot)
 
         return state
 
     async def create_voice_client(self, channel):
+        _ensure_opus()
         voice = await self.bot.join_voice_channel(channel)
         state = self.get_voice_state(channel.server)
         state.voice = voice
 
+    @staticmethod
+    async def _disconnect_all(voices):
+        await asyncio.gather(*(voice.disconnect() for voice in voices), return_exceptions=True)
+
     def __unload(self):
-        for state in self.voice_states.values():
+        states = list(self.voice_states.values())
+        for state in states:
             try:
-                state.audio_player.cancel()
-                if state.voice:
-                    self.bot.loop.create_task(state.voice.disconnect())
+                state.prefetcher.cancel()
+                state.clear_queue()
             except:
                 pass
 
+        voices = [state.voice for state in states if state.voice]
+        if voices:
+            self.bot.loop.create_task(self._disconnect_all(voices))
+
     @commands.group(pass_context=True)
     async def music(self, ctx):
         """Music related commands"""
@@ -104,22 +291,23 @@ class Music:
         try:
             await self.create_voice_client(channel)
         except discord.ClientException:
-            await self.bot.say(lang['MUSIC']['IN_ANOTHER_VOICE_CHANNEL'])
+            await self.bot.say(_IN_ANOTHER_VOICE_CHANNEL)
         except discord.InvalidArgument:
-            await self.bot.say(lang['MUSIC']['NOT_A_VOICE_CHANNEL'])
+            await self.bot.say(_NOT_A_VOICE_CHANNEL)
         else:
-            await self.bot.say(str(lang['MUSIC']['READY_TO_PLAY']).format(channel=channel))
+            await self.bot.say(_READY_TO_PLAY.format(channel=channel))
 
     @music.command(pass_context=True, no_pm=True)
     async def summon(self, ctx):
         """Summons the bot on your voice channel."""
         summoned_channel = ctx.message.author.voice_channel
         if summoned_channel is None:
-            await self.bot.say(lang['MUSIC']['USER_NOT_IN_VOICE_CHANNEL'])
+            await self.bot.say(_USER_NOT_IN_VOICE_CHANNEL)
             return False
 
         state = self.get_voice_state(ctx.message.server)
         if state.voice is None:
+            _ensure_opus()
             state.voice = await self.bot.join_voice_channel(summoned_channel)
         else:
             await state.voice.move_to(summoned_channel)
@@ -136,26 +324,18 @@ class Music:
         https://rg3.github.io/youtube-dl/supportedsites.html
         """
         state = self.get_voice_state(ctx.message.server)
-        opts = {
-            'default_search': 'auto',
-            'quiet': True,
-        }
-
         if state.voice is None:
             success = await ctx.invoke(self.summon)
             if not success:
                 return
 
-        try:
-            player = await state.voice.create_ytdl_player(song, ytdl_options=opts, after=state.toggle_next)
-        except Exception as e:
-            fmt = 'An error occurred while processing this request: ```py\n{}: {}\n```'
-            await self.bot.send_message(ctx.message.channel, fmt.format(type(e).__name__, e))
-        else:
-            player.volume = 0.6
-            entry = VoiceEntry(ctx.message, player)
-            await self.bot.say(str(lang['MUSIC']['ENQUEUE_SUCCESS']).format(entry=entry))
-            await state.songs.put(entry)
+        if len(state.songs) >= MAX_QUEUED_SONGS:
+            await self.bot.say(_QUEUE_FULL.format(max_songs=MAX_QUEUED_SONGS))
+            return
+
+        # Resolution happens in the background, see VoiceState._prefetch_task
+        state.enqueue(ctx.message, song)
+        await self.bot.say(_ENQUEUE_PENDING)
 
     @music.command(pass_context=True, no_pm=True)
     async def volume(self, ctx, value: int):
@@ -165,7 +345,7 @@ class Music:
         if state.is_playing():
             player = state.player
             player.volume = value / 100
-            await self.bot.say(str(lang['MUSIC']['VOLUME_CHANGE']).format(volume=player.volume))
+            await self.bot.say(_VOLUME_CHANGE.format(volume=player.volume))
 
     @music.command(pass_context=True, no_pm=True)
     async def pause(self, ctx):
@@ -189,18 +369,27 @@ class Music:
         This also clears the queue.
         """
         server = ctx.message.server
-        state = self.get_voice_state(server)
-
-        if state.is_playing():
-            player = state.player
-            player.stop()
+        # Claim the state up front so an overlapping stop finds nothing left to tear down.
+        state = self.voice_states.pop(server.id, None)
+        if state is None:
+            return
 
+        # Let the prefetcher finish unwinding before the player and connection go away.
+        state.prefetcher.cancel()
         try:
-            state.audio_player.cancel()
-            del self.voice_states[server.id]
-            await state.voice.disconnect()
-        except:
+            await state.prefetcher
+        except asyncio.CancelledError:
             pass
+        except Exception:
+            # A prefetcher that already died must not keep us connected.
+            log.exception('Prefetch task for server %s ended with an error', server.id)
+
+        state.clear_queue()
+        if state.current and state.current.player:
+            state.current.player.stop()
+
+        if state.voice:
+            await state.voice.disconnect()
 
     @music.command(pass_context=True, no_pm=True)
     async def skip(self, ctx):
@@ -210,24 +399,21 @@ class Music:
 
         state = self.get_voice_state(ctx.message.server)
         if not state.is_playing():
-            await self.bot.say(str(lang['MUSIC']['NOT_PLAYING']))
+            await self.bot.say(_NOT_PLAYING)
             return
 
         voter = ctx.message.author
         if voter == state.current.requester:
-            await self.bot.say(str(lang['MUSIC']['SKIP_REQUESTER']).format(current_song=state.current,
-                                                                           requester=state.current.requester))
+            await self.bot.say(_SKIP_REQUESTER.format(current_song=state.current,
+                                                      requester=state.current.requester))
             state.skip()
         elif voter.id not in state.skip_votes:
-            state.skip_votes.add(voter.id)
-            total_votes = len(state.skip_votes)
-            if total_votes >= 3:
-                await self.bot.say(lang['MUSIC']['SKIP_VOTE_PASSED'])
+            total_votes = state.add_skip_vote(voter.id, ctx.message.channel)
+            if total_votes >= SKIP_VOTES_NEEDED:
                 state.skip()
-            else:
-                await self.bot.say(str(lang['MUSIC']['SKIP_VOTE_PASSED']).format(current_votes=total_votes))
+                await self.bot.say(_SKIP_VOTE_PASSED)
         else:
-            await self.bot.say(lang['MUSIC']['SKIP_ALREADY_VOTED'])
+            await self.bot.say(_SKIP_ALREADY_VOTED)
 
     @music.command(pass_context=True, no_pm=True)
     async def playing(self, ctx):
@@ -235,10 +421,10 @@ class Music:
 
         state = self.get_voice_state(ctx.message.server)
         if state.current is None:
-            await self.bot.say(lang['MUSIC']['NOT_PLAYING'])
+            await self.bot.say(_NOT_PLAYING)
         else:
             # skip_count = len(state.skip_votes)
-            await self.bot.say(str(lang['MUSIC']['NOW_PLAYING']).format(current_song=state.current))
+            await self.bot.say(_NOW_PLAYING.format(current_song=state.current))
 
 
 def setup(bot):